@@ -1,7 +1,10 @@
-from flask import Flask, send_file
+from flask import Flask, Response, jsonify, request
 import os
+import time
+import threading
 from datetime import datetime
 import pytz
+import signal
 import logging
 
 # 配置日志
@@ -12,6 +15,63 @@ logging.basicConfig(
 
 app = Flask(__name__)
 
+ICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ics')
+
+# 邮件监控心跳文件，由 email_monitor.py 定期更新
+HEARTBEAT_FILE = os.getenv("MONITOR_HEARTBEAT_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_monitor.heartbeat'))
+HEARTBEAT_MAX_AGE = int(os.getenv("MONITOR_HEARTBEAT_MAX_AGE", 60*15))
+
+# 设置后才开放 /debug/profile，请求需携带 X-Profile-Token
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+
+
+class FeedCache:
+    """缓存最新的日历文件内容，文件变化时自动重新加载"""
+
+    def __init__(self, ics_dir):
+        self.ics_dir = ics_dir
+        self._lock = threading.Lock()
+        self._dir_mtime = None
+        self._path = None
+        self._mtime = None
+        self._data = None
+
+    def _latest_file(self):
+        """获取 ics 目录下最新的日历文件，目录未变化时复用上次结果"""
+        dir_mtime = os.stat(self.ics_dir).st_mtime_ns
+        if dir_mtime != self._dir_mtime or self._path is None:
+            ics_files = [f for f in os.listdir(self.ics_dir) if f.endswith('.ics')]
+            if not ics_files:
+                self._path = None
+            else:
+                # 按修改时间排序，获取最新的文件
+                latest_file = max(ics_files, key=lambda x: os.path.getmtime(os.path.join(self.ics_dir, x)))
+                self._path = os.path.join(self.ics_dir, latest_file)
+            self._dir_mtime = dir_mtime
+        return self._path
+
+    def get(self):
+        """返回 (文件路径, 修改时间, 内容)，没有日历文件时返回 None"""
+        with self._lock:
+            path = self._latest_file()
+            if path is None:
+                return None
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                self._path = None
+                return None
+            if path != self._path or mtime != self._mtime or self._data is None:
+                with open(path, 'rb') as f:
+                    self._data = f.read()
+                self._mtime = mtime
+                logging.info(f"已重新加载日历文件: {os.path.basename(path)}")
+            return path, self._mtime, self._data
+
+
+feed_cache = FeedCache(ICS_DIR)
+
+
 @app.errorhandler(400)
 def bad_request(e):
     """处理400错误，通常是由HTTPS请求导致的"""
@@ -21,24 +81,52 @@ def bad_request(e):
 @app.route('/ticket')
 def get_calendar():
     """提供最新的车票日历文件"""
-    ics_dir = os.path.join(os.path.dirname(__file__), 'ics')
-    # 获取 ics 目录下最新的日历文件
-    ics_files = [f for f in os.listdir(ics_dir) if f.endswith('.ics')]
-    if not ics_files:
+    feed = feed_cache.get()
+    if feed is None:
         logging.warning("未找到日历文件")
         return "No calendar file found", 404
     
-    # 按修改时间排序，获取最新的文件
-    latest_file = max(ics_files, key=lambda x: os.path.getmtime(os.path.join(ics_dir, x)))
-    file_path = os.path.join(ics_dir, latest_file)
-    
-    logging.info(f"提供日历文件: {latest_file}")
-    return send_file(
-        file_path,
-        mimetype='text/calendar',
-        as_attachment=True,
-        download_name='12306_ticket.ics'
-    )
+    file_path, mtime, data = feed
+    logging.debug(f"提供日历文件: {os.path.basename(file_path)}")
+    response = Response(data, mimetype='text/calendar')
+    response.headers['Content-Disposition'] = 'attachment; filename=12306_ticket.ics'
+    response.set_etag(f"{mtime:x}-{len(data):x}")
+    response.last_modified = datetime.fromtimestamp(mtime / 1e9, tz=pytz.utc)
+    return response.make_conditional(request)
+
+@app.route('/healthz')
+def healthz():
+    """健康检查，报告邮件监控进程是否存活"""
+    try:
+        age = time.time() - os.path.getmtime(HEARTBEAT_FILE)
+    except OSError:
+        age = None
+    monitor_alive = age is not None and age <= HEARTBEAT_MAX_AGE
+    body = {
+        "status": "ok" if monitor_alive else "degraded",
+        "monitor": {
+            "alive": monitor_alive,
+            "heartbeat_age": round(age, 1) if age is not None else None,
+            "max_age": HEARTBEAT_MAX_AGE,
+        },
+        "pid": os.getpid(),
+    }
+    return jsonify(body), 200 if monitor_alive else 503
+
+@app.route('/debug/profile', methods=['POST'])
+def trigger_profile():
+    """通知邮件监控进程开始一次采样（SIGUSR1），结果写入 profiles 目录"""
+    if not PROFILE_TOKEN or request.headers.get('X-Profile-Token') != PROFILE_TOKEN:
+        return "Not Found", 404
+    try:
+        with open(HEARTBEAT_FILE, 'r') as f:
+            pid = int(f.read().strip())
+        os.kill(pid, signal.SIGUSR1)
+    except (OSError, ValueError) as e:
+        logging.error(f"触发性能采样失败: {e}")
+        return jsonify({"triggered": False, "error": str(e)}), 503
+    logging.info(f"已通知邮件监控进程 {pid} 开始性能采样")
+    return jsonify({"triggered": True, "pid": pid}), 202
 
 if __name__ == '__main__':
     logging.info("启动Web服务器在 http://0.0.0.0:2306")
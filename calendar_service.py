@@ -1,22 +1,64 @@
 import os
+import re
+import json
+import fcntl
+import hashlib
+import logging
+import argparse
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from caldav import DAVClient
+from caldav.lib.error import NotFoundError
 from ics import Calendar as IcsCalendar
+from profiling import timed
 
 load_dotenv()
 
+# 本地事件存储与同步状态
+ICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ics')
+LOCAL_CALENDAR_FILE = os.path.join(ICS_DIR, 'tickets.ics')
+SYNC_STATE_FILE = os.path.join(ICS_DIR, 'caldav_state.json')
 
-def add_event(event):
-    """Add an event to a CalDAV calendar."""
+UID_RE = re.compile(r'^UID:(.+?)\r?$', re.MULTILINE)
+
+
+@contextmanager
+def _file_lock(path):
+    """对 path 对应的 .lock 文件加排他锁（跨进程）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def local_calendar_lock(ics_path=LOCAL_CALENDAR_FILE):
+    """对本地日历文件加排他锁，避免 main.py 与后台任务同时读改写"""
+    return _file_lock(ics_path)
+
+
+def sync_state_lock():
+    """对同步状态加排他锁，对账与其它推送路径不会互相覆盖"""
+    return _file_lock(SYNC_STATE_FILE)
+
+
+def _get_client():
+    """根据环境变量创建 CalDAV 客户端"""
     url = os.getenv("CALDAV_URL")
     username = os.getenv("CALDAV_USERNAME")
     password = os.getenv("CALDAV_PASSWORD")
-    calendar_name = os.getenv("CALDAV_CALENDAR_NAME")
 
     if not all([url, username, password]):
         raise ValueError("CalDAV configuration is incomplete")
 
-    client = DAVClient(url, username=username, password=password)
+    return DAVClient(url, username=username, password=password)
+
+
+def _find_calendar(client):
+    """查找目标日历，不存在时创建"""
+    calendar_name = os.getenv("CALDAV_CALENDAR_NAME")
     principal = client.principal()
     calendars = principal.calendars()
     target_cal = calendars[0] if calendars else principal.make_calendar(name=calendar_name or "Calendar")
@@ -26,8 +68,254 @@ def add_event(event):
             if c.name == calendar_name:
                 target_cal = c
                 break
+    return target_cal
 
+
+def _serialize_event(event):
+    """将单个事件序列化为 iCalendar 文本"""
     cal = IcsCalendar()
     cal.events.add(event)
-    target_cal.add_event(cal.serialize())
+    return cal.serialize()
+
+
+def _digest(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _local_digest(data):
+    """按 load_local_events 的方式（解析后重新序列化）计算事件摘要"""
+    event = next(iter(IcsCalendar(data).events))
+    return _digest(_serialize_event(event))
+
+
+@timed()
+def add_event(event):
+    """Add an event to a CalDAV calendar."""
+    add_events([event])
+
+
+@timed()
+def add_events(events):
+    """Add several events to a CalDAV calendar over one connection."""
+    client = _get_client()
+    target_cal = _find_calendar(client)
+    written = []
+    for event in events:
+        data = _serialize_event(event)
+        obj = target_cal.add_event(data)
+        written.append((event.uid, str(obj.url), _local_digest(data)))
+    _record_pushed(str(target_cal.url), written)
+
+
+def _record_pushed(calendar_url, written):
+    """
+    在同步状态中记录已推送事件的摘要，下次对账不会重复推送
+
+    etag 记为 None，表示下次同步拿到的新 etag 来自本程序自己的写入，而不是远端改动。
+    """
+    with sync_state_lock():
+        state = load_sync_state()
+        if state.get("calendar_url") not in (None, calendar_url):
+            return
+        state["calendar_url"] = calendar_url
+        for uid, href, digest in written:
+            state["pushed"][uid] = digest
+            state["remote"][href] = {"uid": uid, "etag": None}
+        save_sync_state(state)
+
+
+def load_sync_state():
+    """加载上次同步的状态"""
+    if os.path.exists(SYNC_STATE_FILE):
+        with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {"calendar_url": None, "sync_token": None, "remote": {}, "pushed": {}}
+
+
+def save_sync_state(state):
+    """保存同步状态"""
+    os.makedirs(os.path.dirname(SYNC_STATE_FILE), exist_ok=True)
+    tmp_file = SYNC_STATE_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, SYNC_STATE_FILE)
+
+
+def load_local_events(ics_path=LOCAL_CALENDAR_FILE):
+    """读取本地日历，返回 {uid: (iCalendar 文本, 内容摘要)}"""
+    if not os.path.exists(ics_path):
+        return {}
+    with open(ics_path, 'r', encoding='utf-8') as f:
+        cal = IcsCalendar(f.read())
+    events = {}
+    for event in cal.events:
+        data = _serialize_event(event)
+        events[event.uid] = (data, _digest(data))
+    return events
+
+
+def _object_etag(obj):
+    """从 CalDAV 对象中取 etag，服务器未返回时用内容摘要代替"""
+    props = getattr(obj, 'props', None) or {}
+    etag = props.get('{DAV:}getetag')
+    if etag:
+        return etag
+    if obj.data:
+        return _digest(obj.data)
+    return None
+
+
+def _object_uid(obj):
+    """从 CalDAV 对象的原始数据中解析 UID"""
+    match = UID_RE.search(obj.data or '')
+    return match.group(1).strip() if match else None
+
+
+def _fetch_remote_changes(calendar, state):
+    """
+    拉取自上次同步以来的远端变化并更新 state["remote"]
+
+    有 sync-token 时只做一次 sync-collection REPORT，无变化即结束；
+    token 失效或服务器不支持时回退为全量同步。
+    :return: etag 与上次记录不同的 UID 集合（即被他人改动过的事件）；
+             上次记录的 etag 为 None 表示由本程序写入，不计为改动
+    """
+    remote = state["remote"]
+    changed_uids = set()
+    token = state.get("sync_token")
+
+    if token:
+        try:
+            changes = calendar.objects_by_sync_token(sync_token=token, load_objects=False)
+        except Exception as e:
+            logging.warning(f"[对账] sync-token 已失效，改为全量同步: {e}")
+            token = None
+
+    if token:
+        for obj in changes:
+            href = str(obj.url)
+            try:
+                obj.load()
+            except NotFoundError:
+                removed = remote.pop(href, None)
+                if removed:
+                    changed_uids.add(removed["uid"])
+                continue
+            uid = _object_uid(obj)
+            if uid:
+                etag = _object_etag(obj)
+                previous_etag = remote.get(href, {}).get("etag")
+                if previous_etag is not None and previous_etag != etag:
+                    changed_uids.add(uid)
+                remote[href] = {"uid": uid, "etag": etag}
+        state["sync_token"] = changes.sync_token
+        return changed_uids
+
+    try:
+        objects = calendar.objects_by_sync_token(sync_token=None, load_objects=True)
+        state["sync_token"] = objects.sync_token
+    except Exception as e:
+        logging.warning(f"[对账] 服务器不支持 sync-collection，使用全量列表: {e}")
+        objects = calendar.events()
+        state["sync_token"] = None
+
+    previous = dict(remote)
+    remote.clear()
+    for obj in objects:
+        uid = _object_uid(obj)
+        if uid:
+            href = str(obj.url)
+            etag = _object_etag(obj)
+            previous_etag = previous.get(href, {}).get("etag")
+            if previous_etag is not None and previous_etag != etag:
+                changed_uids.add(uid)
+            remote[href] = {"uid": uid, "etag": etag}
+    return changed_uids
+
+
+@timed()
+def reconcile(ics_path=LOCAL_CALENDAR_FILE, dry_run=False):
+    """
+    对比本地日历与远端 CalDAV 日历，只推送或删除差异部分
+
+    本地日历为准：本地新增或内容变化的事件会被推送，远端被改动的事件会被覆盖，
+    本地已删除且由本程序推送过的事件会从远端删除。远端其它事件不受影响。
+    :return: 对账结果统计
+    """
+    with sync_state_lock():
+        return _reconcile(ics_path, dry_run)
+
+
+def _reconcile(ics_path, dry_run):
+    state = load_sync_state()
+    local = load_local_events(ics_path)
+    client = _get_client()
+
+    if state.get("calendar_url"):
+        calendar = client.calendar(url=state["calendar_url"])
+    else:
+        calendar = _find_calendar(client)
+        state["calendar_url"] = str(calendar.url)
+        state["sync_token"] = None
+
+    changed_uids = _fetch_remote_changes(calendar, state)
+    remote_hrefs = {info["uid"]: href for href, info in state["remote"].items()}
+    pushed = state["pushed"]
+
+    to_push = [
+        uid for uid, (_, digest) in local.items()
+        if uid not in remote_hrefs or pushed.get(uid) != digest or uid in changed_uids
+    ]
+    to_delete = [uid for uid in pushed if uid not in local and uid in remote_hrefs]
+
+    summary = {"local": len(local), "remote": len(remote_hrefs),
+               "push": len(to_push), "delete": len(to_delete)}
+    logging.info(f"[对账] 本地 {summary['local']} 个事件，远端 {summary['remote']} 个事件，"
+                 f"需推送 {summary['push']} 个，需删除 {summary['delete']} 个")
+    if dry_run or not (to_push or to_delete):
+        if not dry_run:
+            save_sync_state(state)
+        return summary
+
+    for uid in to_push:
+        data, digest = local[uid]
+        calendar.add_event(data)
+        pushed[uid] = digest
+        logging.info(f"[对账] 已推送事件: {uid}")
+
+    for uid in to_delete:
+        href = remote_hrefs[uid]
+        try:
+            calendar.event_by_url(href).delete()
+        except NotFoundError:
+            pass
+        state["remote"].pop(href, None)
+        pushed.pop(uid, None)
+        logging.info(f"[对账] 已删除事件: {uid}")
+
+    # 拉取自己写入产生的变化，使下次无变化的对账只需一次请求
+    _fetch_remote_changes(calendar, state)
+    save_sync_state(state)
+    return summary
+
+
+def main():
+    """命令行入口"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description='CalDAV 日历工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    reconcile_parser = subparsers.add_parser('reconcile', help='对比本地日历与远端日历并同步差异')
+    reconcile_parser.add_argument('--ics-file', default=LOCAL_CALENDAR_FILE, help='本地日历文件路径')
+    reconcile_parser.add_argument('--dry-run', action='store_true', help='只输出差异，不做修改')
+    args = parser.parse_args()
+
+    if args.command == 'reconcile':
+        summary = reconcile(args.ics_file, dry_run=args.dry_run)
+        print(json.dumps(summary, ensure_ascii=False))
+
 
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,21 @@ import logging
 from imap_tools import MailBox, AND
 import subprocess
 import sys
-from typing import Optional, Set
+from typing import Dict, List, Optional, Set, Tuple
 from contextlib import contextmanager
 from dotenv import load_dotenv
 import pickle
 from pathlib import Path
 from email.message import Message
 import shutil
+import re
+import json
+from datetime import datetime, timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+import calendar_service
+import profiling
+import prefetch
+from job_queue import JobQueue
 
 # 加载 .env 文件
 load_dotenv()
@@ -31,6 +39,24 @@ EMAIL = os.getenv("EMAIL_USERNAME")
 PASSWORD = os.getenv("EMAIL_PASSWORD")
 TARGET_SENDER = os.getenv("TARGET_SENDER")  # 从环境变量获取发件人
 
+# IDLE 配置（单位：秒）
+IDLE_TIMEOUT = int(os.getenv("IDLE_TIMEOUT", 60*5))  # 单次 IDLE 等待时间，超时后做一次状态检查
+IDLE_RECONNECT_INTERVAL = int(os.getenv("IDLE_RECONNECT_INTERVAL", 60*25))  # 连接刷新间隔，需小于服务器的 29 分钟限制
+IDLE_DEBOUNCE_MIN = float(os.getenv("IDLE_DEBOUNCE_MIN", 2))  # 新邮件通知的初始合并窗口
+IDLE_DEBOUNCE_MAX = float(os.getenv("IDLE_DEBOUNCE_MAX", 20))  # 合并窗口的最长累计时间
+IDLE_RESPONSE_RE = re.compile(r'^\*\s+(\d+)\s+(EXISTS|RECENT|EXPUNGE|FETCH)\b', re.IGNORECASE)
+
+# 每次调用 main.py 处理的最多邮件数
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", 20))
+
+# CalDAV 对账间隔（分钟），0 表示关闭
+CALDAV_RECONCILE_INTERVAL = int(os.getenv("CALDAV_RECONCILE_INTERVAL", 30))
+# 时刻表预取间隔（分钟），0 表示关闭
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", 60))
+
+# 心跳文件，供 Web 服务的 /healthz 检查监控进程是否存活
+HEARTBEAT_FILE = os.getenv("MONITOR_HEARTBEAT_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_monitor.heartbeat'))
+
 # 使用当前 Python 解释器路径
 PYTHON_PATH = sys.executable
 
@@ -38,6 +64,9 @@ PYTHON_PATH = sys.executable
 PROCESSED_EMAILS_FILE = 'processed_emails.pkl'
 processed_email_ids: Set[str] = set()
 
+# 邮件处理队列，在 main() 中初始化
+job_queue: Optional[JobQueue] = None
+
 def load_processed_emails() -> None:
     """加载已处理的邮件ID"""
     global processed_email_ids
@@ -81,20 +110,133 @@ def get_email_content(msg: Message) -> str:
                     continue
     return content
 
-def process_new_email(mailbox: MailBox) -> None:
-    """处理新邮件"""
+def run_main_script(jobs: List) -> Dict[str, Tuple[bool, bool, str]]:
+    """
+    在一个子进程中运行 main.py 处理一批邮件，整批只读写一次日历、推送一次
+
+    :param jobs: 队列任务列表
+    :return: {邮件ID: (是否成功, 是否为无需重试的失败, 错误信息)}
+    """
+    os.makedirs('temp', exist_ok=True)
+    batch_id = jobs[0]['uid']
+    temp_files = {}
+    for job in jobs:
+        temp_file = os.path.abspath(f"temp/email_{job['uid']}.txt")
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(job['content'])
+        temp_files[job['uid']] = temp_file
+    logging.debug(f"已保存 {len(temp_files)} 封邮件内容到临时文件")
+    results_file = os.path.abspath(f'temp/results_{batch_id}.json')
+    
     try:
-        # 创建临时目录
-        os.makedirs('temp', exist_ok=True)
+        # 使用系统 Python 路径
+        python_path = 'python3' if os.path.exists('/app') else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myenv', 'bin', 'python')
+        logging.debug(f"使用 Python 解释器: {python_path}")
+        logging.debug("开始执行 main.py")
+        
+        main_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ics', 'main.py')
+        # 子进程的耗时统计写入文件后合并到本进程；采样期间让子进程一起采样
+        timings_file = os.path.abspath(f'temp/timings_{batch_id}.json')
+        env = dict(os.environ, **{profiling.TIMINGS_FILE_ENV: timings_file})
+        if profiling.is_capturing():
+            env[profiling.PROFILE_ENV] = '1'
+        with profiling.timer('main_subprocess'):
+            result = subprocess.run(
+                [python_path, main_script, '--results-file', results_file, '--email-file', *temp_files.values()],
+                capture_output=True,
+                text=True,
+                encoding='utf-8',
+                env=env
+            )
+        profiling.collect_timings_file(timings_file)
         
-        # 搜索目标发件人的未读邮件
-        messages = mailbox.fetch(AND(from_=TARGET_SENDER))
-        new_messages = []
+        file_results = {}
+        if result.returncode == 0 and os.path.exists(results_file):
+            with open(results_file, 'r', encoding='utf-8') as f:
+                file_results = json.load(f)
+    finally:
+        # 处理完后删除临时文件
+        for temp_file in temp_files.values():
+            os.remove(temp_file)
+        if os.path.exists(results_file):
+            os.remove(results_file)
+        logging.debug("已删除临时文件")
+    
+    if result.stdout:
+        logging.debug(f"main.py 输出: {result.stdout}")
+    # 整批失败时只保留错误输出的末尾部分作为失败原因
+    batch_error = (result.stderr or f"main.py 退出码 {result.returncode}")[-2000:]
+    
+    statuses = {}
+    for uid, temp_file in temp_files.items():
+        item = file_results.get(temp_file)
+        if item is None:
+            statuses[uid] = (False, False, batch_error)
+        elif item['status'] == 'ok':
+            statuses[uid] = (True, False, "")
+        elif item['status'] == 'no_ticket':
+            statuses[uid] = (False, True, item['reason'])
+        else:
+            statuses[uid] = (False, False, item['reason'])
+    return statuses
+
+def run_due_jobs() -> None:
+    """处理队列中已到期的任务，失败的按指数退避重试，超过次数移入死信表"""
+    jobs = job_queue.due_jobs()
+    if not jobs:
+        return
+    logging.info(f"[队列] 开始处理 {len(jobs)} 个到期任务")
+    # 分批处理，每批共用一次时刻表查询计划、一次日历写入和一次推送
+    for offset in range(0, len(jobs), JOB_BATCH_SIZE):
+        batch = jobs[offset:offset + JOB_BATCH_SIZE]
+        # 每批处理可能持续较久，之前更新心跳，避免 /healthz 误判
+        touch_heartbeat()
+        for job in batch:
+            logging.info(f"[队列] 处理邮件: ID={job['uid']}, 第 {job['attempts'] + 1} 次尝试, 主题={job['subject']}")
+        try:
+            statuses = run_main_script(batch)
+        except Exception as e:
+            logging.exception("详细错误信息:")
+            reason = f"{type(e).__name__}: {e}"
+            statuses = {job['uid']: (False, False, reason) for job in batch}
         
-        # 统计邮件数量
-        all_messages = list(messages)
-        total_count = len(all_messages)
-        logging.info(f"总共找到 {total_count} 封目标邮件")
+        for job in batch:
+            uid = job['uid']
+            ok, permanent, reason = statuses[uid]
+            if ok:
+                job_queue.mark_done(uid)
+                # 标记邮件为已处理
+                processed_email_ids.add(uid)
+                logging.info(f"已处理邮件: ID={uid}")
+            elif permanent:
+                job_queue.dead_letter(uid, job['content'], reason, job['subject'])
+                logging.warning(f"[队列] 邮件 {uid} 无法处理，已移入死信表: {reason}")
+            elif job_queue.mark_failed(uid, reason):
+                logging.error(f"[队列] 邮件 {uid} 多次处理失败，已移入死信表: {reason}")
+            else:
+                logging.error(f"[队列] 处理邮件 {uid} 时出错，稍后重试: {reason}")
+        save_processed_emails()
+    
+    # 最后删除临时目录
+    if os.path.exists('temp'):
+        shutil.rmtree('temp')
+        logging.debug("已清理临时目录")
+
+@profiling.timed()
+def process_new_email(mailbox: MailBox) -> Optional[Tuple[int, int, int]]:
+    """
+    扫描邮箱，将新邮件加入队列后处理到期任务
+
+    :return: 扫描前的收件箱快照，扫描失败时返回 None。快照在搜索之前获取，
+             处理期间到达的邮件会使下一次状态检查发现变化。
+    """
+    touch_heartbeat()
+    snapshot = get_mailbox_snapshot(mailbox)
+    try:
+        # 搜索目标发件人的邮件，只取 UID
+        with profiling.timer('imap_search'):
+            uids = mailbox.uids(AND(from_=TARGET_SENDER))
+        logging.info(f"总共找到 {len(uids)} 封目标邮件")
         
         # 检查日历文件是否存在
         calendar_file = os.path.join('ics', 'tickets.ics')
@@ -102,83 +244,37 @@ def process_new_email(mailbox: MailBox) -> None:
             logging.info("[检查] 日历文件不存在，将重新处理所有邮件")
             processed_email_ids.clear()
         
-        # 找出未处理的新邮件
-        for msg in all_messages:
-            # 如果邮件已处理，检查对应的日历文件是否存在
-            if str(msg.uid) in processed_email_ids:
-                if not os.path.exists(calendar_file):
-                    logging.info(f"[检查] 邮件 {msg.uid} 的日历文件不存在，将重新处理")
-                    processed_email_ids.remove(str(msg.uid))
-                    new_messages.append(msg)
-            else:
-                new_messages.append(msg)
+        # 已处理、已在队列中或已进入死信表的邮件都不再下载
+        known = processed_email_ids | job_queue.known_uids()
+        new_uids = [uid for uid in uids if str(uid) not in known]
         
-        new_count = len(new_messages)
-        if new_count == 0:
-            logging.info("没有新的未处理邮件")
-            return
+        if new_uids:
+            logging.info(f"发现 {len(new_uids)} 封未处理的新邮件")
+            with profiling.timer('imap_fetch'):
+                messages = list(mailbox.fetch(AND(uid=new_uids)))
             
-        logging.info(f"发现 {new_count} 封未处理的新邮件")
-        
-        # 处理每封新邮件
-        for i, msg in enumerate(new_messages, 1):
-            try:
-                logging.info(f"新邮件{i}: ID={msg.uid}, 日期={msg.date}, 主题={msg.subject}")
+            for i, msg in enumerate(messages, 1):
+                touch_heartbeat()
+                uid = str(msg.uid)
+                logging.info(f"新邮件{i}: ID={uid}, 日期={msg.date}, 主题={msg.subject}")
                 
                 # 获取邮件内容
                 content = get_email_content(msg)
                 if not content:
-                    logging.warning(f"无法获取邮件 {msg.uid} 的内容")
+                    logging.warning(f"无法获取邮件 {uid} 的内容，已移入死信表")
+                    job_queue.dead_letter(uid, "", "无法获取邮件内容", msg.subject)
                     continue
-                    
-                # 保存到临时文件
-                temp_file = f'temp/email_{msg.uid}.txt'
-                with open(temp_file, 'w', encoding='utf-8') as f:
-                    f.write(content)
-                logging.debug(f"已保存邮件内容到临时文件: {temp_file}")
-                
-                # 使用系统 Python 路径
-                python_path = 'python3' if os.path.exists('/app') else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myenv', 'bin', 'python')
-                logging.debug(f"使用 Python 解释器: {python_path}")
-                logging.debug("开始执行 main.py")
-                
-                main_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ics', 'main.py')
-                result = subprocess.run(
-                    [python_path, main_script, '--email-file', temp_file],
-                    capture_output=True,
-                    text=True,
-                    encoding='utf-8'
-                )
-                
-                if result.returncode == 0:
-                    logging.info("成功运行 main.py")
-                    if result.stdout:
-                        logging.debug(f"main.py 输出: {result.stdout}")
-                    # 标记邮件为已处理
-                    processed_email_ids.add(str(msg.uid))
-                    save_processed_emails()
-                    logging.debug("已保存处理过的邮件ID")
-                    logging.info(f"已处理邮件: ID={msg.uid}, 日期={msg.date}")
-                else:
-                    logging.error(f"处理邮件时出错: {result.stderr}")
-                
-                # 处理完后删除临时文件
-                os.remove(temp_file)
-                logging.debug(f"已删除临时文件: {temp_file}")
-                
-            except Exception as e:
-                logging.error(f"处理邮件时发生错误: {str(e)}")
-                logging.exception("详细错误信息:")
-                continue
-                    
-        # 最后删除临时目录
-        if os.path.exists('temp'):
-            shutil.rmtree('temp')
-            logging.debug("已清理临时目录")
+                job_queue.enqueue(uid, content, msg.subject)
+        else:
+            logging.info("没有新的未处理邮件")
+        
+        run_due_jobs()
+        return snapshot
                 
     except Exception as e:
         logging.error(f"处理新邮件时发生错误: {str(e)}")
         logging.exception("详细错误信息:")
+        return None
 
 @contextmanager
 def maintain_connection():
@@ -202,9 +298,82 @@ def maintain_connection():
             except Exception as e:
                 logging.error(f"断开连接时发生错误: {str(e)}")
 
+def touch_heartbeat() -> None:
+    """更新心跳文件，内容为当前进程号，供 Web 服务发送性能采样信号"""
+    try:
+        Path(HEARTBEAT_FILE).write_text(str(os.getpid()))
+    except Exception as e:
+        logging.warning(f"更新心跳文件失败: {str(e)}")
+
+def classify_idle_responses(responses: List[bytes], known_exists: Optional[int]) -> Tuple[bool, bool, Optional[int]]:
+    """解析 IDLE 未标记响应，区分新邮件到达与标记变化
+
+    :param responses: mailbox.idle.wait 返回的原始响应
+    :param known_exists: 当前已知的邮件总数（EXISTS），未知时为 None
+    :return: (是否有新邮件, 是否有标记变化, 更新后的邮件总数)
+    """
+    has_new = False
+    has_flags = False
+    for raw in responses:
+        if not isinstance(raw, bytes):
+            continue
+        line = raw.decode('utf-8', errors='replace').strip()
+        logging.debug(f"[IDLE] 收到响应: {line}")
+        match = IDLE_RESPONSE_RE.match(line)
+        if not match:
+            continue
+        number, kind = int(match.group(1)), match.group(2).upper()
+        if kind == 'EXISTS':
+            # 邮件总数增加才视为新邮件到达，删除邮件后服务器同样会发送 EXISTS
+            if known_exists is None or number > known_exists:
+                has_new = True
+            known_exists = number
+        elif kind == 'RECENT':
+            if number > 0:
+                has_new = True
+        elif kind == 'EXPUNGE':
+            if known_exists:
+                known_exists -= 1
+        elif kind == 'FETCH':
+            has_flags = True
+    return has_new, has_flags, known_exists
+
+def collect_burst(mailbox: MailBox, known_exists: Optional[int]) -> Optional[int]:
+    """合并短时间内连续到达的邮件通知
+
+    窗口从 IDLE_DEBOUNCE_MIN 开始，每次窗口内又有新邮件到达就加倍，
+    直到出现一个安静窗口或累计等待达到 IDLE_DEBOUNCE_MAX。
+    """
+    window = IDLE_DEBOUNCE_MIN
+    burst_start = time.time()
+    while True:
+        elapsed = time.time() - burst_start
+        remaining = IDLE_DEBOUNCE_MAX - elapsed
+        if remaining <= 0:
+            logging.debug("[合并] 已达到最长合并时间")
+            break
+        responses = mailbox.idle.wait(timeout=min(window, remaining))
+        has_new, _, known_exists = classify_idle_responses(responses, known_exists)
+        if not has_new:
+            break
+        window = min(window * 2, IDLE_DEBOUNCE_MAX)
+        logging.debug(f"[合并] 窗口内仍有新邮件，窗口调整为 {window} 秒")
+    logging.info(f"[合并] 通知合并完成，耗时 {time.time() - burst_start:.1f} 秒")
+    return known_exists
+
+def get_mailbox_snapshot(mailbox: MailBox) -> Optional[Tuple[int, int, int]]:
+    """通过 STATUS 获取收件箱快照 (UIDVALIDITY, UIDNEXT, MESSAGES)"""
+    try:
+        status = mailbox.folder.status('INBOX', ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY'])
+        return status.get('UIDVALIDITY'), status.get('UIDNEXT'), status.get('MESSAGES')
+    except Exception as e:
+        logging.warning(f"[状态] 获取收件箱状态失败: {str(e)}")
+        return None
+
 def monitor_emails():
     """使用 IMAP IDLE 监控邮件"""
     first_run = True  # 添加标志位
+    snapshot = None  # 上一次扫描前的收件箱快照，跨重连保留
     while True:
         try:
             with maintain_connection() as mailbox:
@@ -215,47 +384,59 @@ def monitor_emails():
                 # 只在首次运行时处理现有邮件
                 if first_run:
                     logging.info("[初始化] 系统首次启动，开始处理现有邮件...")
-                    process_new_email(mailbox)
+                    snapshot = process_new_email(mailbox)
                     first_run = False
                     logging.info("[初始化] 初始邮件处理完成")
                     logging.info("-" * 50)  # 添加分隔线
+                else:
+                    # 重连后检查断开期间是否有新邮件
+                    current = get_mailbox_snapshot(mailbox)
+                    if current is None or current != snapshot:
+                        logging.info("[维护] 重连期间收件箱状态变化，开始扫描...")
+                        snapshot = process_new_email(mailbox)
+                
+                known_exists = snapshot[2] if snapshot else None
+                connected_at = time.time()
                 
                 # 开始 IDLE 监听
                 logging.info("[监听] 开始 IMAP IDLE 监听模式")
                 logging.info("[状态] 等待新邮件...")
-                idle_start_time = time.time()
                 
-                # 使用 imap_tools 的 IDLE 功能
-                for idle_response in mailbox.idle.wait(timeout=60*5):  # 5分钟超时
-                    if isinstance(idle_response, bytes):
-                        response_str = idle_response.decode('utf-8')
-                        logging.debug(f"[IDLE] 收到响应: {response_str}")
+                while time.time() - connected_at < IDLE_RECONNECT_INTERVAL:
+                    touch_heartbeat()
+                    # 有待重试任务时提前醒来，重试不需要重新扫描邮箱
+                    retry_in = job_queue.next_due_in()
+                    timeout = IDLE_TIMEOUT if retry_in is None else max(1, min(IDLE_TIMEOUT, retry_in))
+                    responses = mailbox.idle.wait(timeout=timeout)
+                    
+                    if responses:
+                        has_new, has_flags, known_exists = classify_idle_responses(responses, known_exists)
+                        if not has_new:
+                            if has_flags:
+                                logging.debug("[IDLE] 仅邮件标记变化，忽略")
+                            continue
                         
-                        # 检查各种可能的新邮件通知
-                        if any(keyword in response_str.upper() for keyword in ['EXISTS', 'RECENT', 'FETCH']):
-                            logging.info("[新邮件] 检测到新邮件到达")
-                            logging.info("[处理中] 等待10秒确保邮件同步...")
-                            time.sleep(10)  # 等待10秒确保邮件同步
-                            
-                            # 重新选择收件箱以刷新状态
-                            mailbox.folder.set('INBOX')
-                            process_new_email(mailbox)
-                            logging.info("[完成] 新邮件处理完成")
-                            logging.info("[状态] 继续等待新邮件...")
-                            
-                            # 重置空闲计时器
-                            idle_start_time = time.time()
+                        logging.info("[新邮件] 检测到新邮件到达，等待通知合并...")
+                        known_exists = collect_burst(mailbox, known_exists)
+                    else:
+                        run_due_jobs()
+                        # 周期检查：仅当收件箱状态变化或日历文件丢失时才重新扫描
+                        current = get_mailbox_snapshot(mailbox)
+                        calendar_missing = not os.path.exists(os.path.join('ics', 'tickets.ics'))
+                        if current is not None and current == snapshot and not calendar_missing:
+                            logging.debug("[维护] 收件箱状态未变化，跳过扫描")
+                            continue
+                        logging.info("[维护] 收件箱状态变化，开始扫描...")
                     
-                    # 检查是否需要刷新连接
-                    current_time = time.time()
-                    if current_time - idle_start_time > 60*5:  # 5分钟后刷新
-                        logging.info("[维护] IMAP IDLE 连接超时，准备刷新...")
-                        break
+                    # 重新选择收件箱以刷新状态
+                    mailbox.folder.set('INBOX')
+                    snapshot = process_new_email(mailbox)
+                    if snapshot:
+                        known_exists = snapshot[2]
+                    logging.info("[完成] 新邮件处理完成")
+                    logging.info("[状态] 继续等待新邮件...")
                 
                 logging.info("[维护] 正在刷新 IMAP 连接...")
-                # 在刷新连接时检查新邮件
-                mailbox.folder.set('INBOX')
-                process_new_email(mailbox)
                 logging.info("=" * 50)  # 添加分隔线
                 
         except Exception as e:
@@ -264,6 +445,39 @@ def monitor_emails():
             logging.info("[重试] 30秒后尝试重新连接...")
             time.sleep(30)
 
+def reconcile_calendar() -> None:
+    """后台任务：对比本地日历与 CalDAV 日历并同步差异"""
+    try:
+        summary = calendar_service.reconcile()
+        logging.debug(f"[对账] 完成: {summary}")
+    except Exception as e:
+        logging.error(f"[对账] CalDAV 对账失败: {str(e)}")
+
+def prefetch_timetables() -> None:
+    """后台任务：刷新即将出发行程的时刻表"""
+    try:
+        prefetch.refresh_timetables()
+    except Exception as e:
+        logging.error(f"[预取] 刷新时刻表失败: {str(e)}")
+
+def start_scheduler() -> Optional[BackgroundScheduler]:
+    """启动后台定时任务"""
+    # 单线程执行，预取与对账不会同时占用资源
+    scheduler = BackgroundScheduler(executors={'default': {'type': 'threadpool', 'max_workers': 1}})
+    if os.getenv("CALDAV_URL") and CALDAV_RECONCILE_INTERVAL > 0:
+        scheduler.add_job(reconcile_calendar, 'interval', minutes=CALDAV_RECONCILE_INTERVAL,
+                          id='caldav_reconcile', max_instances=1, coalesce=True)
+        logging.info(f"[对账] 已启动 CalDAV 对账任务，间隔 {CALDAV_RECONCILE_INTERVAL} 分钟")
+    if PREFETCH_INTERVAL > 0:
+        scheduler.add_job(prefetch_timetables, 'interval', minutes=PREFETCH_INTERVAL,
+                          id='timetable_prefetch', max_instances=1, coalesce=True,
+                          next_run_time=datetime.now() + timedelta(minutes=1))
+        logging.info(f"[预取] 已启动时刻表预取任务，间隔 {PREFETCH_INTERVAL} 分钟")
+    if not scheduler.get_jobs():
+        return None
+    scheduler.start()
+    return scheduler
+
 def main():
     """主函数"""
     logging.info("邮件监控服务启动")
@@ -271,6 +485,11 @@ def main():
     
     # 加载已处理的邮件ID
     load_processed_emails()
+    global job_queue
+    job_queue = JobQueue()
+    touch_heartbeat()
+    profiling.install_signal_handlers('email_monitor')
+    start_scheduler()
     
     while True:
         try:
@@ -0,0 +1,22 @@
+"""Gunicorn 生产环境配置，参数均可通过环境变量调整"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('WEB_PORT', '2306')}"
+
+# 每个 worker 使用线程池处理请求，适合大量订阅端轮询
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_WORKERS', 2))
+threads = int(os.getenv('WEB_THREADS', 8))
+
+# 保持连接，减少订阅端重复握手
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+
+# 定期回收 worker，避免长时间运行后内存增长
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = os.getenv('WEB_ACCESS_LOG', '-') or None
+errorlog = '-'
+loglevel = os.getenv('WEB_LOG_LEVEL', 'info')
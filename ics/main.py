@@ -4,6 +4,7 @@ import email.utils
 import re
 import json
 import datetime
+import time
 import sys
 import os
 import logging
@@ -28,8 +29,10 @@ logging.basicConfig(
 
 # 导入 train_query.py
 sys.path.insert(0, parent_dir)
-from train_query import query_arrival_time
-from calendar_service import add_event as push_event
+from train_query import query_arrival_time, query_station_times
+from ticket import Ticket, arrival_after, NO_TICKET_EXIT_CODE
+import profiling
+from calendar_service import add_events as push_events, local_calendar_lock
 
 def connect_to_email(username, password):
     """连接到邮箱"""
@@ -104,6 +107,7 @@ def fetch_and_parse_email(mail, email_id):
                     continue
     return ""
 
+@profiling.timed()
 def extract_ticket_info(email_content):
     """提取车票信息"""
     # 支持三种邮件格式，按优先级排序：
@@ -143,80 +147,49 @@ def extract_ticket_info(email_content):
             logging.info(f"  票价: {price}")
             logging.info(f"  检票口原始信息: {gate}")
             
-            return travel_date, travel_time, from_station, to_station, train_number, seat, seat_type, price, gate
+            return Ticket.parse(travel_date, travel_time, from_station, to_station, train_number, seat, seat_type, price, gate)
             
     logging.error("未能匹配任何已知格式")
     return None
 
-def create_calendar_event(ticket_info):
-    """生成日历事件"""
+def build_event(ticket, arrival_time):
+    """根据车票信息和到达时间生成日历事件"""
     try:
         logging.info("开始创建日历事件...")
-        c = Calendar()
         e = Event()
-        e.name = f"{ticket_info[4]} {ticket_info[2]} - {ticket_info[3]}"
+        e.uid = ticket.uid
+        e.name = f"{ticket.train_code} {ticket.from_station}站 - {ticket.to_station}站"
         
         # 创建中国时区
         tz = pytz.timezone('Asia/Shanghai')
         
         # 设置出发时间
-        departure_str = f"{ticket_info[0]} {ticket_info[1]}:00"
-        logging.debug(f"原始出发时间字符串: {departure_str}")
-        departure_naive = datetime.datetime.strptime(departure_str, "%Y年%m月%d日 %H:%M:%S")
-        departure_local = tz.localize(departure_naive)
-        e.begin = departure_local
+        e.begin = tz.localize(ticket.departure)
         logging.debug(f"设置出发时间: {e.begin}")
         
-        # 转换日期格式和站名格式
-        logging.debug(f"原始日期: {ticket_info[0]}")
-        date_obj = datetime.datetime.strptime(ticket_info[0], "%Y年%m月%d日")
-        date_str = date_obj.strftime("%Y-%m-%d")
-        logging.debug(f"转换后日期: {date_str}")
-        
-        logging.debug(f"原始站名: {ticket_info[3]}")
-        station_name = ticket_info[3].replace("站", "")
-        logging.debug(f"处理后站名: {station_name}")
-        
-        # 处理车次号
-        logging.debug(f"原始车次号: {ticket_info[4]}")
-        train_code = ticket_info[4].strip()
-        logging.debug(f"处理后车次号: {train_code}")
-        
-        # 设置到达时间
-        logging.info("开始查询到达时间...")
-        logging.debug(f"查询参数 - 日期: {date_str}, 车次: {train_code}, 站名: {station_name}")
-        arrival_time = query_arrival_time(date_str, train_code, station_name)
-        logging.debug(f"查询结果: {arrival_time}")
-        
+        arrival_naive = None
         if arrival_time:
             try:
                 # 验证时间格式
-                datetime.datetime.strptime(arrival_time, "%H:%M")
-                arrival_str = f"{ticket_info[0]} {arrival_time}:00"
+                arrival_clock = datetime.datetime.strptime(arrival_time, "%H:%M").time()
+                arrival_naive = arrival_after(ticket.departure, arrival_clock)
                 logging.info(f"成功获取到达时间: {arrival_time}")
             except ValueError:
                 logging.warning(f"获取的到达时间格式无效: {arrival_time}")
-                arrival_time = ""
         
-        if not arrival_time:
+        if arrival_naive is None:
             logging.warning("未能获取到达时间，将使用预估时间...")
             # 如果查询不到到达时间，使用出发时间加2小时作为预估到达时间
-            departure_time_obj = datetime.datetime.strptime(ticket_info[1], "%H:%M")
-            arrival_time_obj = departure_time_obj + datetime.timedelta(hours=2)
-            arrival_time = arrival_time_obj.strftime("%H:%M")
-            arrival_str = f"{ticket_info[0]} {arrival_time}:00"
-            logging.warning(f"使用预估到达时间：{arrival_time}")
+            arrival_naive = ticket.departure + datetime.timedelta(hours=2)
+            logging.warning(f"使用预估到达时间：{arrival_naive.strftime('%H:%M')}")
             
-        logging.debug(f"完整到达时间字符串: {arrival_str}")
-        arrival_naive = datetime.datetime.strptime(arrival_str, "%Y年%m月%d日 %H:%M:%S")
-        arrival_local = tz.localize(arrival_naive)
-        e.end = arrival_local
+        e.end = tz.localize(arrival_naive)
         logging.debug(f"设置到达时间: {e.end}")
         
-        e.description = f"座位：{ticket_info[5]}\n" \
-                       f"座位类型：{ticket_info[6]}\n" \
-                       f"票价：{ticket_info[7]}元\n" \
-                       f"检票口：{ticket_info[8]}"
+        e.description = f"座位：{ticket.seat}\n" \
+                       f"座位类型：{ticket.seat_type}\n" \
+                       f"票价：{ticket.price}元\n" \
+                       f"检票口：{ticket.gate}"
         
         logging.info("日历事件创建完成")
         return e
@@ -226,20 +199,125 @@ def create_calendar_event(ticket_info):
         logging.exception("详细错误信息:")
         raise
 
+def create_calendar_event(ticket):
+    """生成日历事件"""
+    date_str, train_code, station_name = ticket.date_str, ticket.train_code, ticket.to_station
+    
+    # 设置到达时间
+    logging.info("开始查询到达时间...")
+    logging.debug(f"查询参数 - 日期: {date_str}, 车次: {train_code}, 站名: {station_name}")
+    arrival_time = query_arrival_time(date_str, train_code, station_name)
+    logging.debug(f"查询结果: {arrival_time}")
+    
+    return build_event(ticket, arrival_time)
+
+def build_lookup_plan(tickets):
+    """
+    按 (日期, 车次) 分组车票，同一车次只需查询一次时刻表
+    
+    :param tickets: Ticket 列表
+    :return: {(日期, 车次): [(车票下标, 到达站), ...]}
+    """
+    plan = {}
+    for index, ticket in enumerate(tickets):
+        plan.setdefault((ticket.date_str, ticket.train_code), []).append((index, ticket.to_station))
+    return plan
+
+def create_calendar_events(tickets, timings=None):
+    """
+    批量生成日历事件，单张车票失败不影响其它车票
+    
+    :param tickets: Ticket 列表
+    :param timings: 传入列表时按车票顺序填入 {"lookup": 所在车次的查询耗时, "build": 生成事件耗时}
+    :return: (events, failures, estimated)，events 与输入顺序一致，失败的位置为 None；
+             failures 为 {车票下标: 失败原因}；estimated 为 {车票下标: 原因}，
+             表示未查到到达时间、事件使用了预估到达时间的车票
+    """
+    plan = build_lookup_plan(tickets)
+    logging.info(f"批量创建 {len(tickets)} 个日历事件，需查询 {len(plan)} 个车次")
+    
+    arrival_times = [""] * len(tickets)
+    lookup_times = [0.0] * len(tickets)
+    estimated = {}
+    for (date_str, train_code), members in plan.items():
+        logging.info(f"查询时刻表 - 日期: {date_str}, 车次: {train_code}, 车票数: {len(members)}")
+        start = time.perf_counter()
+        lookup_error = None
+        try:
+            stops = query_station_times(date_str, train_code)
+            if not stops:
+                lookup_error = "未获取到时刻表"
+        except Exception as e:
+            logging.error(f"查询 {date_str} {train_code} 时刻表失败，将使用预估时间: {e}")
+            stops = {}
+            lookup_error = f"时刻表查询失败: {type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - start
+        for index, station_name in members:
+            stop = stops.get(station_name)
+            arrival_times[index] = stop[0] if stop else ""
+            lookup_times[index] = elapsed
+            if not arrival_times[index]:
+                estimated[index] = lookup_error or f"时刻表中没有到达站 {station_name}"
+    
+    events = []
+    failures = {}
+    for index, (ticket, arrival_time) in enumerate(zip(tickets, arrival_times)):
+        start = time.perf_counter()
+        try:
+            events.append(build_event(ticket, arrival_time))
+        except Exception as e:
+            events.append(None)
+            failures[index] = f"{type(e).__name__}: {e}"
+        if timings is not None:
+            timings.append({"lookup": lookup_times[index], "build": time.perf_counter() - start})
+    return events, failures, estimated
+
+def persist_events(events, ics_file_path):
+    """加锁读取现有日历，合并新事件后写回"""
+    with local_calendar_lock(ics_file_path):
+        # 创建或加载现有日历
+        if os.path.exists(ics_file_path):
+            with open(ics_file_path, 'r', encoding='utf-8') as f:
+                cal = Calendar(f.read())
+            logging.info("已加载现有日历文件")
+        else:
+            cal = Calendar()
+            logging.info("创建新的日历文件")
+
+        for event in events:
+            cal.events.add(event)
+        logging.info(f"已添加 {len(events)} 个新的日历事件")
+
+        # 先写临时文件再替换，未加锁的读取方不会读到写了一半的文件
+        with profiling.timer('ics_write'):
+            tmp_file = ics_file_path + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(str(cal))
+            os.replace(tmp_file, ics_file_path)
+        logging.info(f"已更新日历文件: {ics_file_path}")
+
 def process_email_file(file_path):
     """处理单个邮件文件"""
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
-            ticket_info = extract_ticket_info(content)
-            if ticket_info:
-                return ticket_info
+            ticket = extract_ticket_info(content)
+            if ticket:
+                return ticket
     except Exception as e:
         logging.error(f"处理文件 {file_path} 时出错: {str(e)}")
     return None
 
+def write_results_file(path, results):
+    """写出每个邮件文件的处理结果，供邮件监控逐封更新队列状态"""
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False)
+    os.replace(tmp_file, path)
+
 def main():
     """主函数"""
+    profiling.profile_process('main')
     try:
         logging.info("开始处理车票信息")
         # 加载环境变量
@@ -248,54 +326,72 @@ def main():
         
         # 检查临时目录参数
         parser = argparse.ArgumentParser()
-        parser.add_argument('--email-file', required=True, help='要处理的邮件文件路径')
+        parser.add_argument('--email-file', required=True, nargs='+', help='要处理的邮件文件路径，可传入多个')
+        parser.add_argument('--results-file', help='逐个邮件文件的处理结果（JSON），指定后退出码只表示整批是否完成')
         args = parser.parse_args()
         
-        if not os.path.exists(args.email_file):
-            logging.error(f"邮件文件不存在: {args.email_file}")
-            return
-            
-        logging.info(f"处理邮件文件: {args.email_file}")
-        ticket_info = process_email_file(args.email_file)
-        
-        if not ticket_info:
-            logging.warning("未找到有效的车票信息")
-            return
-
-        # 创建或加载现有日历
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        ics_file_path = os.path.join(current_dir, 'tickets.ics')
+        # 每个邮件文件的结果: {"status": "ok" | "no_ticket" | "failed", "reason": ...}
+        results = {}
+        tickets = []
+        ticket_files = []
+        for email_file in args.email_file:
+            if not os.path.exists(email_file):
+                logging.error(f"邮件文件不存在: {email_file}")
+                results[email_file] = {"status": "failed", "reason": "邮件文件不存在"}
+                continue
+                
+            logging.info(f"处理邮件文件: {email_file}")
+            ticket = process_email_file(email_file)
+            if ticket:
+                tickets.append(ticket)
+                ticket_files.append(email_file)
+            else:
+                logging.warning(f"未找到有效的车票信息: {email_file}")
+                results[email_file] = {"status": "no_ticket", "reason": "未找到有效的车票信息"}
         
-        if os.path.exists(ics_file_path):
-            with open(ics_file_path, 'r', encoding='utf-8') as f:
-                cal = Calendar(f.read())
-            logging.info("已加载现有日历文件")
-        else:
-            cal = Calendar()
-            logging.info("创建新的日历文件")
+        events = []
+        if tickets:
+            # 创建事件
+            logging.info("开始创建日历事件")
+            events, failures, estimated = create_calendar_events(tickets)
+            for index, reason in estimated.items():
+                logging.warning(f"车票 {tickets[index].train_code} {tickets[index].date_str} 使用预估到达时间: {reason}")
+            for index, email_file in enumerate(ticket_files):
+                if index in failures:
+                    logging.error(f"车票 {tickets[index].train_code} {tickets[index].date_str} 创建日历事件失败: {failures[index]}")
+                    results[email_file] = {"status": "failed", "reason": failures[index]}
+                else:
+                    results[email_file] = {"status": "ok", "reason": None}
+            events = [event for event in events if event is not None]
 
-        # 创建事件
-        logging.info("开始创建日历事件")
-        event = create_calendar_event(ticket_info)
-        if event:
-            cal.events.add(event)
-            logging.info("已添加新的日历事件")
-
-            # 保存日历文件
-            with open(ics_file_path, 'w', encoding='utf-8') as f:
-                f.write(str(cal))
-            logging.info(f"已更新日历文件: {ics_file_path}")
+        if events:
+            # 写入本地日历，整批只读写一次
+            ics_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tickets.ics')
+            persist_events(events, ics_file_path)
 
-            # 推送到 CalDAV 日历
+            # 推送到 CalDAV 日历，整批共用一个连接
             try:
-                push_event(event)
+                push_events(events)
                 logging.info("已同步事件到 CalDAV 日历")
             except Exception as e:
                 logging.error(f"同步到 CalDAV 日历失败: {e}")
 
+        if args.results_file:
+            write_results_file(args.results_file, results)
+            return
+
+        if not tickets:
+            sys.exit(NO_TICKET_EXIT_CODE)
+        if not events:
+            logging.error("所有车票都未能创建日历事件")
+            sys.exit(1)
+
     except Exception as e:
         logging.error(f"处理过程中发生错误: {str(e)}", exc_info=True)
         raise
+    finally:
+        logging.debug(f"[性能] 耗时统计: {profiling.timing_report()}")
+        profiling.write_timings_file()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+"""
+基于 SQLite 的邮件处理队列
+
+每封待处理邮件保存其内容、尝试次数和下次重试时间，失败后按指数退避重试，
+超过最大次数移入死信表。重试直接使用保存的内容，无需重新扫描邮箱。
+"""
+import os
+import time
+import sqlite3
+import argparse
+from typing import List, Optional, Set
+
+JOB_QUEUE_DB = os.getenv("JOB_QUEUE_DB", "jobs.db")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_RETRY_BASE = float(os.getenv("JOB_RETRY_BASE", 60))  # 首次重试等待秒数，之后每次加倍
+JOB_RETRY_MAX = float(os.getenv("JOB_RETRY_MAX", 60*60*6))  # 单次重试最长等待秒数
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    uid TEXT PRIMARY KEY,
+    subject TEXT,
+    content TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_next_attempt ON jobs (next_attempt);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    uid TEXT PRIMARY KEY,
+    subject TEXT,
+    content TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    reason TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+
+
+class JobQueue:
+    """邮件处理队列"""
+
+    def __init__(self, path: str = JOB_QUEUE_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def known_uids(self) -> Set[str]:
+        """队列中和死信表中的全部邮件ID，扫描邮箱时直接跳过"""
+        rows = self.conn.execute("SELECT uid FROM jobs UNION SELECT uid FROM dead_letters")
+        return {row["uid"] for row in rows}
+
+    def enqueue(self, uid: str, content: str, subject: str = "") -> bool:
+        """加入队列，已在队列或死信表中的邮件会被忽略"""
+        if self.conn.execute("SELECT 1 FROM dead_letters WHERE uid = ?", (uid,)).fetchone():
+            return False
+        now = time.time()
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO jobs (uid, subject, content, next_attempt, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (uid, subject, content, now, now, now)
+            )
+        return cursor.rowcount > 0
+
+    def due_jobs(self, now: Optional[float] = None) -> List[sqlite3.Row]:
+        """到期需要处理的任务"""
+        now = time.time() if now is None else now
+        return self.conn.execute(
+            "SELECT * FROM jobs WHERE next_attempt <= ? ORDER BY next_attempt", (now,)
+        ).fetchall()
+
+    def next_due_in(self) -> Optional[float]:
+        """距离下一个任务到期的秒数，没有任务时返回 None"""
+        row = self.conn.execute("SELECT MIN(next_attempt) AS t FROM jobs").fetchone()
+        if row["t"] is None:
+            return None
+        return max(0.0, row["t"] - time.time())
+
+    def mark_done(self, uid: str) -> None:
+        """处理成功，移出队列"""
+        with self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE uid = ?", (uid,))
+
+    def mark_failed(self, uid: str, reason: str) -> bool:
+        """
+        记录一次失败，按指数退避安排下次重试
+
+        :return: 达到最大尝试次数并移入死信表时返回 True
+        """
+        row = self.conn.execute("SELECT * FROM jobs WHERE uid = ?", (uid,)).fetchone()
+        if row is None:
+            return False
+        attempts = row["attempts"] + 1
+        now = time.time()
+        with self.conn:
+            if attempts >= JOB_MAX_ATTEMPTS:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO dead_letters (uid, subject, content, attempts, reason, failed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (uid, row["subject"], row["content"], attempts, reason, now)
+                )
+                self.conn.execute("DELETE FROM jobs WHERE uid = ?", (uid,))
+                return True
+            delay = min(JOB_RETRY_BASE * 2 ** (attempts - 1), JOB_RETRY_MAX)
+            self.conn.execute(
+                "UPDATE jobs SET attempts = ?, next_attempt = ?, last_error = ?, updated_at = ? WHERE uid = ?",
+                (attempts, now + delay, reason, now, uid)
+            )
+        return False
+
+    def dead_letter(self, uid: str, content: str, reason: str, subject: str = "") -> None:
+        """直接移入死信表，用于无法重试的邮件"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dead_letters (uid, subject, content, attempts, reason, failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (uid, subject, content, 0, reason, time.time())
+            )
+            self.conn.execute("DELETE FROM jobs WHERE uid = ?", (uid,))
+
+    def dead_letters(self) -> List[sqlite3.Row]:
+        return self.conn.execute(
+            "SELECT uid, subject, attempts, reason, failed_at FROM dead_letters ORDER BY failed_at"
+        ).fetchall()
+
+    def pending(self) -> List[sqlite3.Row]:
+        return self.conn.execute(
+            "SELECT uid, subject, attempts, next_attempt, last_error FROM jobs ORDER BY next_attempt"
+        ).fetchall()
+
+    def retry_dead(self, uid: str) -> bool:
+        """将死信重新放回队列并清零尝试次数"""
+        row = self.conn.execute("SELECT * FROM dead_letters WHERE uid = ?", (uid,)).fetchone()
+        if row is None:
+            return False
+        now = time.time()
+        with self.conn:
+            self.conn.execute("DELETE FROM dead_letters WHERE uid = ?", (uid,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (uid, subject, content, next_attempt, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (uid, row["subject"], row["content"], now, now, now)
+            )
+        return True
+
+
+def main():
+    """命令行：查看队列和死信，或将死信重新入队"""
+    parser = argparse.ArgumentParser(description='邮件处理队列')
+    parser.add_argument('--db', default=JOB_QUEUE_DB, help='队列数据库路径')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('pending', help='查看待处理任务')
+    subparsers.add_parser('dead', help='查看死信')
+    retry_parser = subparsers.add_parser('retry', help='将死信重新入队')
+    retry_parser.add_argument('uid', nargs='+', help='邮件ID')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.db)
+    try:
+        if args.command == 'pending':
+            for row in queue.pending():
+                due = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['next_attempt']))
+                print(f"{row['uid']}\t尝试 {row['attempts']} 次\t下次 {due}\t{row['subject']}\t{row['last_error'] or ''}")
+        elif args.command == 'dead':
+            for row in queue.dead_letters():
+                print(f"{row['uid']}\t尝试 {row['attempts']} 次\t{row['subject']}\t{row['reason']}")
+        elif args.command == 'retry':
+            for uid in args.uid:
+                print(f"{uid}: {'已重新入队' if queue.retry_dead(uid) else '不在死信表中'}")
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
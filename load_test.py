@@ -0,0 +1,83 @@
+"""
+/ticket 压测脚本
+
+用法示例：
+    python load_test.py --url http://127.0.0.1:2306/ticket --concurrency 32 --duration 30
+"""
+import argparse
+import threading
+import time
+import requests
+
+
+def worker(url, deadline, conditional, results, lock):
+    """循环请求直到截止时间，记录每次请求的耗时和状态码"""
+    session = requests.Session()
+    etag = None
+    latencies = []
+    statuses = {}
+    errors = 0
+    while time.time() < deadline:
+        headers = {'If-None-Match': etag} if conditional and etag else {}
+        start = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, timeout=10)
+            response.content
+        except requests.RequestException:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        etag = response.headers.get('ETag', etag)
+    with lock:
+        results['latencies'].extend(latencies)
+        results['errors'] += errors
+        for code, count in statuses.items():
+            results['statuses'][code] = results['statuses'].get(code, 0) + count
+
+
+def percentile(values, pct):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/ticket 压测')
+    parser.add_argument('--url', default='http://127.0.0.1:2306/ticket', help='压测地址')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发连接数')
+    parser.add_argument('--duration', type=float, default=20, help='压测时长（秒）')
+    parser.add_argument('--conditional', action='store_true', help='携带 If-None-Match，模拟日历客户端轮询')
+    args = parser.parse_args()
+
+    results = {'latencies': [], 'errors': 0, 'statuses': {}}
+    lock = threading.Lock()
+    start = time.time()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(args.url, deadline, args.conditional, results, lock))
+        for _ in range(args.concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(results['latencies'])
+    total = len(latencies)
+    print(f"地址: {args.url}")
+    print(f"并发: {args.concurrency}, 时长: {elapsed:.1f} 秒")
+    print(f"请求数: {total}, 错误: {results['errors']}, 状态码: {results['statuses']}")
+    print(f"吞吐量: {total / elapsed:.1f} 请求/秒")
+    if total:
+        print(f"延迟 (ms): p50={percentile(latencies, 50)*1000:.1f} "
+              f"p95={percentile(latencies, 95)*1000:.1f} "
+              f"p99={percentile(latencies, 99)*1000:.1f} "
+              f"max={latencies[-1]*1000:.1f}")
+
+
+if __name__ == '__main__':
+    main()
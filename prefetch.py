@@ -0,0 +1,162 @@
+"""
+时刻表预取：为日历中即将出发的行程定期刷新 12306 时刻表
+
+刷新结果写入共享的时刻表缓存，新邮件处理时可直接命中；到达时间有变化的事件
+会更新本地日历并单独推送到 CalDAV。
+"""
+import os
+import time
+import logging
+import datetime
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+import pytz
+from ics import Calendar
+
+import calendar_service
+from calendar_service import LOCAL_CALENDAR_FILE, local_calendar_lock
+from ticket import arrival_after, normalize_station
+from train_query import fetch_station_times, get_cache_age, store_stops
+from profiling import timed
+
+PREFETCH_HORIZON_DAYS = int(os.getenv("PREFETCH_HORIZON_DAYS", 30))  # 只刷新该天数内出发的行程
+PREFETCH_BUDGET = int(os.getenv("PREFETCH_BUDGET", 5))  # 每轮最多查询的时刻表数量
+PREFETCH_MIN_AGE = int(os.getenv("PREFETCH_MIN_AGE", 60*60*6))  # 缓存未超过该秒数的车次本轮跳过
+PREFETCH_PAUSE = float(os.getenv("PREFETCH_PAUSE", 5))  # 两次查询之间的间隔，避免占满资源
+
+TZ = pytz.timezone('Asia/Shanghai')
+
+
+def parse_trip(event) -> Tuple[str, str, str]:
+    """从事件中还原 (日期, 车次, 到达站)，事件名称格式为 "G20 南京南站 - 上海站" """
+    train_code, route = event.name.split(" ", 1)
+    to_station = normalize_station(route.rsplit(" - ", 1)[1])
+    date_str = event.begin.datetime.astimezone(TZ).strftime("%Y-%m-%d")
+    return date_str, train_code, to_station
+
+
+def build_refresh_plan(cal: Calendar, now: datetime.datetime) -> Dict[Tuple[str, str], List[str]]:
+    """按 (日期, 车次) 分组即将出发的行程的事件 UID，按出发时间排序"""
+    horizon = now + datetime.timedelta(days=PREFETCH_HORIZON_DAYS)
+    plan: Dict[Tuple[str, str], List[str]] = {}
+    for event in sorted(cal.events, key=lambda e: e.begin):
+        begin = event.begin.datetime
+        if not (now <= begin <= horizon):
+            continue
+        try:
+            date_str, train_code, _ = parse_trip(event)
+        except (ValueError, IndexError, AttributeError):
+            logging.debug(f"[预取] 无法解析事件: {event.name}")
+            continue
+        plan.setdefault((date_str, train_code), []).append(event.uid)
+    return plan
+
+
+def _updated_end(event, stops) -> Optional[datetime.datetime]:
+    """根据最新时刻表计算事件结束时间，时刻表中没有到达站时返回 None"""
+    _, _, to_station = parse_trip(event)
+    stop = stops.get(to_station)
+    if not stop or not stop[0]:
+        return None
+    try:
+        arrival_clock = datetime.datetime.strptime(stop[0], "%H:%M").time()
+    except ValueError:
+        return None
+    departure = event.begin.datetime.astimezone(TZ).replace(tzinfo=None)
+    return TZ.localize(arrival_after(departure, arrival_clock))
+
+
+@timed()
+def refresh_timetables(budget: int = PREFETCH_BUDGET, ics_path: str = LOCAL_CALENDAR_FILE, push: bool = True) -> dict:
+    """
+    刷新即将出发行程的时刻表
+
+    出发时间越早越优先，缓存较新的车次跳过，每轮最多查询 budget 个车次。
+    :return: 本轮统计
+    """
+    if not os.path.exists(ics_path):
+        return {"planned": 0, "attempted": 0, "fetched": 0, "updated": 0}
+
+    with open(ics_path, 'r', encoding='utf-8') as f:
+        cal = Calendar(f.read())
+    plan = build_refresh_plan(cal, datetime.datetime.now(TZ))
+
+    # 预算按查询次数计算，失败的查询同样计入
+    fetched: Dict[Tuple[str, str], dict] = {}
+    attempts = 0
+    for date_str, train_code in plan:
+        if attempts >= budget:
+            break
+        age = get_cache_age(date_str, train_code)
+        if age is not None and age < PREFETCH_MIN_AGE:
+            continue
+        if attempts:
+            time.sleep(PREFETCH_PAUSE)
+        attempts += 1
+        logging.info(f"[预取] 刷新时刻表: {date_str} {train_code}")
+        try:
+            stops = fetch_station_times(date_str, train_code)
+        except Exception as e:
+            logging.error(f"[预取] 查询 {date_str} {train_code} 时刻表失败: {e}")
+            continue
+        if stops:
+            store_stops(date_str, train_code, stops)
+            fetched[(date_str, train_code)] = stops
+        else:
+            logging.warning(f"[预取] 未获取到 {date_str} {train_code} 的时刻表")
+
+    # 到达时间有变化的事件逐个更新，重新读取日历避免覆盖期间新增的事件
+    changed = []
+    if fetched:
+        with local_calendar_lock(ics_path):
+            with open(ics_path, 'r', encoding='utf-8') as f:
+                cal = Calendar(f.read())
+            for event in cal.events:
+                try:
+                    key = parse_trip(event)[:2]
+                except (ValueError, IndexError, AttributeError):
+                    continue
+                if key not in fetched:
+                    continue
+                try:
+                    new_end = _updated_end(event, fetched[key])
+                    if new_end and new_end != event.end.datetime:
+                        logging.info(f"[预取] {event.name} 到达时间变化: {event.end.datetime.strftime('%H:%M')} -> {new_end.strftime('%H:%M')}")
+                        event.end = new_end
+                        changed.append(event)
+                except Exception as e:
+                    logging.error(f"[预取] 更新事件 {event.name} 失败: {e}")
+            if changed:
+                tmp_file = ics_path + '.tmp'
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    f.write(str(cal))
+                os.replace(tmp_file, ics_path)
+
+    if changed and push and os.getenv("CALDAV_URL"):
+        try:
+            calendar_service.add_events(changed)
+        except Exception as e:
+            logging.error(f"[预取] 推送更新的事件失败: {e}")
+
+    summary = {"planned": len(plan), "attempted": attempts, "fetched": len(fetched), "updated": len(changed)}
+    logging.info(f"[预取] 完成: 待刷新车次 {summary['planned']} 个，本轮查询 {summary['attempted']} 次，"
+                 f"成功 {summary['fetched']} 个，更新事件 {summary['updated']} 个")
+    return summary
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description='刷新即将出发行程的时刻表')
+    parser.add_argument('--budget', type=int, default=PREFETCH_BUDGET, help='最多查询的时刻表数量')
+    parser.add_argument('--ics-file', default=LOCAL_CALENDAR_FILE, help='本地日历文件路径')
+    parser.add_argument('--no-push', action='store_true', help='不推送更新到 CalDAV')
+    args = parser.parse_args()
+    refresh_timetables(args.budget, args.ics_file, push=not args.no_push)
+
+
+if __name__ == '__main__':
+    main()
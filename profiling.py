@@ -0,0 +1,243 @@
+"""
+性能分析工具
+
+- timed / timer：按函数统计调用次数和耗时（墙钟时间）
+- StackSampler：采样所有线程的调用栈，输出 flamegraph.pl / speedscope 可直接读取的折叠栈格式
+- install_signal_handlers：SIGUSR1 触发一次采样，SIGUSR2 导出耗时统计
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Optional
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_SAMPLE_SECONDS = float(os.getenv("PROFILE_SAMPLE_SECONDS", 30))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+
+# 子进程通过该环境变量得知需要采样
+PROFILE_ENV = "TICKET_PROFILE"
+# 子进程将耗时统计写入该环境变量指定的文件，由父进程合并
+TIMINGS_FILE_ENV = "TICKET_TIMINGS_FILE"
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, list] = {}  # 名称 -> [调用次数, 总耗时, 最大耗时]
+
+
+def _record(name: str, elapsed: float) -> None:
+    with _stats_lock:
+        stat = _stats.get(name)
+        if stat is None:
+            _stats[name] = [1, elapsed, elapsed]
+        else:
+            stat[0] += 1
+            stat[1] += elapsed
+            if elapsed > stat[2]:
+                stat[2] = elapsed
+
+
+@contextmanager
+def timer(name: str):
+    """统计一段代码的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+
+def timed(name: Optional[str] = None):
+    """统计函数耗时的装饰器，默认使用函数名"""
+    def decorator(func):
+        label = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(label, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def timing_report() -> Dict[str, dict]:
+    """返回按总耗时排序的统计结果（单位：秒）"""
+    with _stats_lock:
+        items = sorted(_stats.items(), key=lambda kv: kv[1][1], reverse=True)
+        return {
+            name: {"calls": count, "total": round(total, 6), "avg": round(total / count, 6), "max": round(peak, 6)}
+            for name, (count, total, peak) in items
+        }
+
+
+def merge_timings(report: Dict[str, dict]) -> None:
+    """合并其它进程导出的 timing_report() 结果"""
+    with _stats_lock:
+        for name, item in report.items():
+            stat = _stats.get(name)
+            if stat is None:
+                _stats[name] = [item["calls"], item["total"], item["max"]]
+            else:
+                stat[0] += item["calls"]
+                stat[1] += item["total"]
+                stat[2] = max(stat[2], item["max"])
+
+
+def write_timings_file() -> None:
+    """父进程设置了 TICKET_TIMINGS_FILE 时，将本进程的耗时统计写入该文件"""
+    path = os.getenv(TIMINGS_FILE_ENV)
+    if not path:
+        return
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(timing_report(), f)
+    except OSError as e:
+        logging.warning(f"[性能] 写入耗时统计失败: {e}")
+
+
+def collect_timings_file(path: str) -> None:
+    """读取子进程写入的耗时统计并合并，随后删除文件"""
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            merge_timings(json.load(f))
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"[性能] 读取子进程耗时统计失败: {e}")
+    finally:
+        os.remove(path)
+
+
+def _dump_path(prefix: str, kind: str, ext: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    return os.path.join(PROFILE_DIR, f"{prefix}-{kind}-{stamp}-{os.getpid()}.{ext}")
+
+
+def dump_timings(prefix: str) -> Optional[str]:
+    """将耗时统计写入 JSON 文件，没有数据时不写"""
+    report = timing_report()
+    if not report:
+        return None
+    path = _dump_path(prefix, "timings", "json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logging.info(f"[性能] 已导出耗时统计: {path}")
+    return path
+
+
+class StackSampler:
+    """后台线程定期采样所有线程的调用栈"""
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _collapse(frame, thread_name: str) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ";".join(reversed(stack))
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self.samples[self._collapse(frame, names.get(thread_id, str(thread_id)))] += 1
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def dump(self, prefix: str) -> str:
+        """写出折叠栈文件，每行格式为 "栈;帧 次数" """
+        path = _dump_path(prefix, "stacks", "folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logging.info(f"[性能] 已导出采样结果: {path}（{sum(self.samples.values())} 个样本）")
+        return path
+
+
+_capture_lock = threading.RLock()
+_active_sampler: Optional[StackSampler] = None
+
+
+def is_capturing() -> bool:
+    """当前是否正在采样"""
+    return _active_sampler is not None
+
+
+def capture(prefix: str, duration: float = PROFILE_SAMPLE_SECONDS) -> bool:
+    """
+    在后台采样指定时长后导出结果，不阻塞调用方
+
+    :return: 已有采样在进行时返回 False
+    """
+    global _active_sampler
+    with _capture_lock:
+        if _active_sampler is not None:
+            return False
+        _active_sampler = StackSampler()
+        _active_sampler.start()
+
+    def finish():
+        global _active_sampler
+        time.sleep(duration)
+        sampler = _active_sampler
+        sampler.stop()
+        with _capture_lock:
+            _active_sampler = None
+        sampler.dump(prefix)
+        dump_timings(prefix)
+
+    logging.info(f"[性能] 开始采样 {duration} 秒")
+    threading.Thread(target=finish, name="profile-capture", daemon=True).start()
+    return True
+
+
+def install_signal_handlers(prefix: str) -> None:
+    """注册信号：SIGUSR1 开始采样，SIGUSR2 导出耗时统计（仅 Unix）"""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: capture(prefix))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: dump_timings(prefix))
+
+
+def profile_process(prefix: str) -> Optional[StackSampler]:
+    """若父进程正在采样（设置了 TICKET_PROFILE），对当前进程整体采样，退出时导出"""
+    if not os.getenv(PROFILE_ENV):
+        return None
+    import atexit
+    sampler = StackSampler()
+    sampler.start()
+
+    def finish():
+        sampler.stop()
+        sampler.dump(prefix)
+        dump_timings(prefix)
+
+    atexit.register(finish)
+    return sampler
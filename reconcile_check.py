@@ -0,0 +1,163 @@
+"""
+CalDAV 对账检查：启动本地 Radicale 服务器，验证 reconcile 的请求数和推送、删除行为
+
+需要额外安装 radicale：
+    pip install radicale
+    python reconcile_check.py
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import tempfile
+import datetime
+import subprocess
+
+import pytz
+from caldav import DAVClient
+from ics import Calendar, Event
+
+import calendar_service
+
+TZ = pytz.timezone('Asia/Shanghai')
+USERNAME = 'check'
+PASSWORD = 'check'
+
+# ics 库生成的事件缺少 DTSTAMP，caldav 会逐条告警，这里只保留错误
+logging.getLogger('caldav').setLevel(logging.ERROR)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_radicale(storage_dir, port):
+    """以无认证模式启动 Radicale，等待端口可用"""
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'radicale', '--config', '',
+         '--server-hosts', f'127.0.0.1:{port}',
+         '--auth-type', 'none',
+         '--storage-filesystem-folder', storage_dir],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Radicale 启动失败')
+
+
+def make_event(uid, name, hour):
+    event = Event()
+    event.uid = uid
+    event.name = name
+    event.begin = TZ.localize(datetime.datetime(2030, 1, 8, hour, 0))
+    event.end = TZ.localize(datetime.datetime(2030, 1, 8, hour + 2, 0))
+    return event
+
+
+def write_local(ics_path, events):
+    cal = Calendar()
+    for event in events:
+        cal.events.add(event)
+    with open(ics_path, 'w', encoding='utf-8') as f:
+        f.write(str(cal))
+
+
+class RequestCounter:
+    """统计 DAVClient 发出的 HTTP 请求数"""
+
+    def __init__(self):
+        self.count = 0
+        self._original = DAVClient.request
+
+    def __enter__(self):
+        counter = self
+
+        def request(client, *args, **kwargs):
+            counter.count += 1
+            return counter._original(client, *args, **kwargs)
+
+        DAVClient.request = request
+        return self
+
+    def __exit__(self, *exc):
+        DAVClient.request = self._original
+
+
+def remote_events(url):
+    client = DAVClient(url, username=USERNAME, password=PASSWORD)
+    calendar = client.principal().calendars()[0]
+    return {calendar_service._object_uid(obj): obj for obj in calendar.events()}
+
+
+def check(condition, message):
+    print(f"{'通过' if condition else '失败'}: {message}")
+    if not condition:
+        raise SystemExit(1)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as work_dir:
+        port = free_port()
+        url = f'http://127.0.0.1:{port}/'
+        process = start_radicale(os.path.join(work_dir, 'storage'), port)
+        try:
+            os.environ.update(CALDAV_URL=url, CALDAV_USERNAME=USERNAME, CALDAV_PASSWORD=PASSWORD)
+            os.environ.pop('CALDAV_CALENDAR_NAME', None)
+            calendar_service.SYNC_STATE_FILE = os.path.join(work_dir, 'caldav_state.json')
+            ics_path = os.path.join(work_dir, 'tickets.ics')
+
+            a = make_event('a@check', 'G1 北京南站 - 上海虹桥站', 8)
+            b = make_event('b@check', 'G2 上海虹桥站 - 北京南站', 14)
+            write_local(ics_path, [a, b])
+
+            summary = calendar_service.reconcile(ics_path)
+            check(summary['push'] == 2, f"首次对账推送 2 个事件 {summary}")
+            check(set(remote_events(url)) == {'a@check', 'b@check'}, "远端包含两个事件")
+
+            with RequestCounter() as counter:
+                summary = calendar_service.reconcile(ics_path)
+            check(summary['push'] == 0 and summary['delete'] == 0, f"无变化时不推送也不删除 {summary}")
+            check(counter.count == 1, f"无变化的对账只发出 1 个请求（实际 {counter.count} 个）")
+
+            # 远端改动：本地为准，应被覆盖
+            remote = remote_events(url)['a@check']
+            remote.data = remote.data.replace('SUMMARY:G1', 'SUMMARY:X1')
+            remote.save()
+            summary = calendar_service.reconcile(ics_path)
+            check(summary['push'] == 1, f"远端被改动的事件重新推送 {summary}")
+            check('SUMMARY:G1' in remote_events(url)['a@check'].data, "远端事件恢复为本地内容")
+
+            # 本地删除 b、新增 c
+            c = make_event('c@check', 'G3 南京南站 - 上海站', 18)
+            write_local(ics_path, [a, c])
+            summary = calendar_service.reconcile(ics_path)
+            check(summary['push'] == 1 and summary['delete'] == 1, f"本地新增推送 1 个、删除 1 个 {summary}")
+            check(set(remote_events(url)) == {'a@check', 'c@check'}, "远端与本地一致")
+
+            # 其它路径推送的事件（main.py / 预取）不应在下次对账时重复推送
+            d = make_event('d@check', 'G4 杭州东站 - 上海虹桥站', 10)
+            write_local(ics_path, [a, c, d])
+            calendar_service.add_events([d])
+            summary = calendar_service.reconcile(ics_path)
+            check(summary['push'] == 0, f"add_events 推送过的事件不重复推送 {summary}")
+
+            with RequestCounter() as counter:
+                summary = calendar_service.reconcile(ics_path)
+            check(counter.count == 1 and summary['push'] == 0, f"最终无变化的对账只发出 1 个请求（实际 {counter.count} 个）")
+        finally:
+            process.terminate()
+            process.wait()
+    print("全部检查通过")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+离线回放：从 mbox 文件或 .eml 目录读取邮件，走与线上相同的解析、补全和保存流程
+
+用法示例：
+    python replay.py corpus.mbox --workers 4 --report report.jsonl
+    python replay.py emails/ --no-lookup --output /tmp/replay.ics
+"""
+import os
+import sys
+import json
+import time
+import email
+import logging
+import argparse
+import mailbox
+from email import policy
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator, Tuple
+
+# 导入 ics/main.py
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(current_dir, 'ics'))
+from main import extract_ticket_info, build_event, create_calendar_events, persist_events
+
+
+def iter_messages(source: str) -> Iterator[Tuple[str, bytes]]:
+    """按顺序读取邮件，返回 (邮件标识, 原始内容)"""
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith('.eml'):
+                with open(os.path.join(source, name), 'rb') as f:
+                    yield name, f.read()
+    else:
+        box = mailbox.mbox(source, create=False)
+        try:
+            for key in box.iterkeys():
+                yield f"{os.path.basename(source)}#{key}", box.get_bytes(key)
+        finally:
+            box.close()
+
+
+def get_message_content(raw: bytes) -> str:
+    """获取邮件正文，与 email_monitor 一致优先使用 HTML 内容"""
+    msg = email.message_from_bytes(raw, policy=policy.default)
+    for content_type in ('text/html', 'text/plain'):
+        for part in msg.walk():
+            if part.get_content_type() != content_type:
+                continue
+            try:
+                content = part.get_content()
+            except Exception:
+                continue
+            if content.strip():
+                return content
+    return ""
+
+
+def process_message(item: Tuple[str, bytes]) -> dict:
+    """解析单封邮件，返回包含车票和各阶段耗时的结果"""
+    msg_id, raw = item
+    result = {"id": msg_id, "ticket": None, "error": None, "timings": {}}
+    try:
+        start = time.perf_counter()
+        content = get_message_content(raw)
+        result["timings"]["decode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ticket = extract_ticket_info(content) if content else None
+        result["timings"]["extract"] = time.perf_counter() - start
+
+        if ticket:
+            result["ticket"] = ticket
+        else:
+            result["error"] = "未找到车票信息" if content else "无法获取邮件内容"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def run_pipeline(source: str, workers: int):
+    """并行解析所有邮件，按完成顺序逐个返回结果"""
+    messages = iter_messages(source)
+    if workers <= 1:
+        for item in messages:
+            yield process_message(item)
+        return
+
+    # 限制在途任务数量，避免一次性把整个语料读入内存
+    max_pending = workers * 4
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in messages:
+            pending.add(executor.submit(process_message, item))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in pending:
+            yield future.result()
+
+
+def percentile(values, pct):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从本地邮件语料回放车票处理流程')
+    parser.add_argument('source', help='mbox 文件或包含 .eml 文件的目录')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='解析进程数，1 表示在当前进程运行')
+    parser.add_argument('--no-lookup', action='store_true', help='不查询 12306 时刻表，到达时间使用预估值')
+    parser.add_argument('--output', default=os.path.join(current_dir, 'output', 'replay.ics'), help='生成的日历文件路径')
+    parser.add_argument('--report', help='逐封邮件的结果报告（JSON Lines）')
+    parser.add_argument('--log-level', default='WARNING', help='日志级别')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    started = time.perf_counter()
+    results = list(run_pipeline(args.source, args.workers))
+    parse_elapsed = time.perf_counter() - started
+
+    parsed = [r for r in results if r["ticket"]]
+    tickets = [r["ticket"] for r in parsed]
+
+    # 补全到达时间，车票与邮件一一对应，单张失败只记在对应邮件上
+    start = time.perf_counter()
+    if args.no_lookup:
+        events = []
+        for r in parsed:
+            build_start = time.perf_counter()
+            try:
+                events.append(build_event(r["ticket"], ""))
+            except Exception as e:
+                events.append(None)
+                r["error"] = f"{type(e).__name__}: {e}"
+            r["timings"]["build"] = time.perf_counter() - build_start
+    else:
+        timings = []
+        events, build_failures, estimated = create_calendar_events(tickets, timings)
+        for index, r in enumerate(parsed):
+            r["timings"].update(timings[index])
+            if index in build_failures:
+                r["error"] = build_failures[index]
+            elif index in estimated:
+                # 未查到到达时间视为补全失败，事件仍按预估时间保存
+                r["estimated"] = estimated[index]
+                r["error"] = f"到达时间为预估值: {estimated[index]}"
+    enrich_elapsed = time.perf_counter() - start
+
+    # 与 main.py 相同的加锁读取、合并、写回流程，全部事件只保存一次，耗时按邮件平均分摊
+    start = time.perf_counter()
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    built = [(r, event) for r, event in zip(parsed, events) if event is not None]
+    if built:
+        try:
+            persist_events([event for _, event in built], args.output)
+            persist_error = None
+        except Exception as e:
+            persist_error = f"{type(e).__name__}: {e}"
+        share = (time.perf_counter() - start) / len(built)
+        for r, _ in built:
+            r["timings"]["persist"] = share
+            if persist_error:
+                r["error"] = persist_error
+            elif "estimated" not in r:
+                r["ok"] = True
+    persist_elapsed = time.perf_counter() - start
+
+    failures = [r for r in results if not r.get("ok")]
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            for r in results:
+                ticket = r["ticket"]
+                report_file.write(json.dumps({
+                    "id": r["id"],
+                    "ok": bool(r.get("ok")),
+                    "error": r["error"],
+                    "estimated": r.get("estimated"),
+                    "ticket": ticket.to_dict() if ticket else None,
+                    "timings_ms": {k: round(v * 1000, 3) for k, v in r["timings"].items()},
+                }, ensure_ascii=False) + "\n")
+
+    total = len(results)
+    print(f"邮件数: {total}, 成功: {total - len(failures)}, 失败: {len(failures)}")
+    print(f"解析耗时: {parse_elapsed:.2f} 秒 ({total / parse_elapsed if parse_elapsed else 0:.1f} 封/秒, {args.workers} 进程)")
+    print(f"补全耗时: {enrich_elapsed:.2f} 秒, 保存耗时: {persist_elapsed:.2f} 秒 -> {args.output}")
+    for stage in ("decode", "extract", "lookup", "build", "persist"):
+        values = [r["timings"][stage] for r in results if stage in r["timings"]]
+        if values:
+            print(f"{stage} 耗时 (ms): p50={percentile(values, 50)*1000:.2f} "
+                  f"p95={percentile(values, 95)*1000:.2f} max={max(values)*1000:.2f}")
+    for r in failures[:20]:
+        print(f"  失败 {r['id']}: {r['error']}")
+    if len(failures) > 20:
+        print(f"  ... 其余 {len(failures) - 20} 个失败见报告")
+
+if __name__ == '__main__':
+    main()
@@ -5,5 +5,10 @@ set -e
 # 启动邮件监控
 python email_monitor.py &
 
-# 启动 Web 服务
-python app.py
+# 启动 Web 服务（WEB_SERVER=dev 时使用 Flask 开发服务器）
+if [ "${WEB_SERVER:-gunicorn}" = "dev" ]; then
+    python app.py
+else
+    # 发送 HUP 信号可平滑重启 worker：kill -HUP <gunicorn 主进程>
+    exec gunicorn -c gunicorn.conf.py app:app
+fi
@@ -0,0 +1,95 @@
+import datetime
+import hashlib
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional
+
+
+# main.py 未能从邮件中提取车票时的退出码，邮件监控据此直接移入死信表，不再重试
+NO_TICKET_EXIT_CODE = 3
+
+
+def normalize_station(name: str) -> str:
+    """去掉站名首尾空白和末尾的"站"字，例如 '南京南站' -> '南京南'"""
+    name = name.strip()
+    return name[:-1] if name.endswith("站") else name
+
+
+def arrival_after(departure: datetime.datetime, arrival_clock: datetime.time) -> datetime.datetime:
+    """到达时刻早于出发时刻时视为次日到达（夜车）"""
+    arrival = datetime.datetime.combine(departure.date(), arrival_clock)
+    if arrival <= departure:
+        arrival += datetime.timedelta(days=1)
+    return arrival
+
+
+@dataclass(frozen=True)
+class Ticket:
+    """车票信息，日期时间只解析一次，站名统一去掉"站"字"""
+
+    __slots__ = ("departure", "from_station", "to_station", "train_code",
+                 "seat", "seat_type", "price", "gate")
+
+    departure: datetime.datetime  # 出发时间（北京时间，不带时区）
+    from_station: str
+    to_station: str
+    train_code: str
+    seat: str
+    seat_type: str
+    price: str
+    gate: Optional[str]
+
+    @classmethod
+    def parse(cls, travel_date: str, travel_time: str, from_station: str, to_station: str,
+              train_code: str, seat: str, seat_type: str, price: str,
+              gate: Optional[str] = None) -> "Ticket":
+        """
+        由邮件中提取的原始字段构造车票
+
+        :param travel_date: 日期，例如 '2025年1月8日'
+        :param travel_time: 开车时间，例如 '08:30'
+        """
+        departure = datetime.datetime.strptime(f"{travel_date} {travel_time}", "%Y年%m月%d日 %H:%M")
+        return cls(
+            departure=departure,
+            from_station=normalize_station(from_station),
+            to_station=normalize_station(to_station),
+            train_code=train_code.strip(),
+            seat=seat.strip(),
+            seat_type=seat_type.strip(),
+            price=price.strip(),
+            gate=gate.strip() if gate else None,
+        )
+
+    @property
+    def date_str(self) -> str:
+        """出发日期，格式为 YYYY-MM-DD"""
+        return self.departure.strftime("%Y-%m-%d")
+
+    @property
+    def key(self) -> str:
+        """车票的稳定标识，同一张票多次解析结果相同"""
+        raw = "|".join([self.departure.isoformat(), self.train_code,
+                        self.from_station, self.to_station, self.seat])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+    @property
+    def uid(self) -> str:
+        """日历事件 UID"""
+        return f"{self.key}@12306ics"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为可 JSON 序列化的字典"""
+        data = asdict(self)
+        data["departure"] = self.departure.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Ticket":
+        """由 to_dict 的结果还原"""
+        data = dict(data)
+        data["departure"] = datetime.datetime.fromisoformat(data["departure"])
+        return cls(**data)
+
+    def __reduce__(self):
+        # frozen + __slots__ 的默认 pickle 会调用 __setattr__，这里按位置参数重建
+        return (self.__class__, tuple(getattr(self, name) for name in self.__slots__))
@@ -6,28 +6,118 @@ from datetime import datetime
 import requests
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+import json
+import sqlite3
+import logging
+from profiling import timed
 
-def query_station_time(date_str: str, train_code: str, station_name: str) -> Optional[Tuple[str, str]]:
+# 精简浏览模式：拦截非必要资源，直接截获时刻表接口返回的 JSON
+PLAYWRIGHT_LEAN = os.getenv("PLAYWRIGHT_LEAN", "1") != "0"
+LOOKUP_STEP_TIMEOUT = int(os.getenv("LOOKUP_STEP_TIMEOUT_MS", 8000))  # 每一步的超时时间（毫秒）
+BLOCKED_RESOURCE_TYPES = {"image", "font", "stylesheet", "media", "imageset", "texttrack", "beacon", "csp_report", "manifest"}
+BLOCKED_URL_KEYWORDS = ("hm.baidu.com", "google-analytics", "googletagmanager", "cnzz.com", "/otn/resources/images/")
+TRAIN_INFO_URL = "https://kyfw.12306.cn/otn/queryTrainInfo/init"
+TRAIN_INFO_API = "/otn/queryTrainInfo/query"
+
+# 时刻表缓存，供 main.py 和后台预取任务共享
+TIMETABLE_CACHE_DB = os.getenv("TIMETABLE_CACHE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ics', 'timetable_cache.db'))
+TIMETABLE_CACHE_TTL = int(os.getenv("TIMETABLE_CACHE_TTL", 60*60*12))  # 缓存有效期（秒）
+
+def _cache_connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(TIMETABLE_CACHE_DB), exist_ok=True)
+    conn = sqlite3.connect(TIMETABLE_CACHE_DB, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS timetables ("
+        "date TEXT NOT NULL, train_code TEXT NOT NULL, stops TEXT NOT NULL, fetched_at REAL NOT NULL, "
+        "PRIMARY KEY (date, train_code))"
+    )
+    return conn
+
+def get_cached_stops(date_str: str, train_code: str, max_age: float = TIMETABLE_CACHE_TTL) -> Optional[Dict[str, Tuple[str, str]]]:
+    """读取缓存的时刻表，不存在或已过期时返回 None"""
+    try:
+        conn = _cache_connect()
+        try:
+            row = conn.execute(
+                "SELECT stops, fetched_at FROM timetables WHERE date = ? AND train_code = ?",
+                (date_str, train_code)
+            ).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.warning(f"[缓存] 读取时刻表缓存失败: {e}")
+        return None
+    if row is None or time.time() - row[1] > max_age:
+        return None
+    return {station: tuple(times) for station, times in json.loads(row[0]).items()}
+
+def get_cache_age(date_str: str, train_code: str) -> Optional[float]:
+    """缓存时刻表的已存在秒数，没有缓存时返回 None"""
+    try:
+        conn = _cache_connect()
+        try:
+            row = conn.execute(
+                "SELECT fetched_at FROM timetables WHERE date = ? AND train_code = ?",
+                (date_str, train_code)
+            ).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return time.time() - row[0] if row else None
+
+def store_stops(date_str: str, train_code: str, stops: Dict[str, Tuple[str, str]]) -> None:
+    """写入时刻表缓存"""
+    try:
+        conn = _cache_connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO timetables (date, train_code, stops, fetched_at) VALUES (?, ?, ?, ?)",
+                    (date_str, train_code, json.dumps(stops, ensure_ascii=False), time.time())
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.warning(f"[缓存] 写入时刻表缓存失败: {e}")
+
+def query_station_times(date_str: str, train_code: str, refresh: bool = False) -> Dict[str, Tuple[str, str]]:
     """
-    查询指定日期、车次和车站的到达和开车时间
+    查询指定日期、车次的全部经停站时刻，优先使用缓存
     
     :param date_str: 查询日期，示例格式 '2025-01-08'
     :param train_code: 车次号，例如 'G20'
-    :param station_name: 车站名称，例如 '南京南'
-    :return: 返回一个元组 (到达时间, 开车时间)，如果未找到则返回 None
+    :param refresh: 为 True 时忽略缓存，重新查询
+    :return: 返回字典 {车站名: (到达时间, 开车时间)}，查询失败时返回空字典
     """
+    if not refresh:
+        cached = get_cached_stops(date_str, train_code)
+        if cached is not None:
+            logging.info(f"[缓存] 命中时刻表缓存: {date_str} {train_code}")
+            return cached
+    
+    stops = fetch_station_times(date_str, train_code)
+    if stops:
+        store_stops(date_str, train_code, stops)
+    return stops
+
+def fetch_station_times(date_str: str, train_code: str) -> Dict[str, Tuple[str, str]]:
+    """从 12306 查询全部经停站时刻，不使用缓存"""
+    if PLAYWRIGHT_LEAN:
+        stops = query_train_stops(date_str, train_code)
+        if stops:
+            return stops
+        logging.warning(f"[查询] 精简模式未获取到 {train_code} 时刻表，改用完整页面查询")
+    
     html_content = query_train_info(date_str, train_code)
     
     soup = BeautifulSoup(html_content, "html.parser")
     table_body = soup.select_one("#_query_table_datas")
     if not table_body:
-        return None
-    
-    rows = table_body.find_all("tr")
-    if not rows:
-        return None
+        return {}
     
-    for row in rows:
+    stops = {}
+    for row in table_body.find_all("tr"):
         # 找到车站信息容器
         station_div = row.select_one(".t-station")
         if not station_div:
@@ -53,11 +143,113 @@ def query_station_time(date_str: str, train_code: str, station_name: str) -> Opt
         if arrive_time == "----":
             arrive_time = ""
             
-        if station == station_name:
-            return arrive_time, depart_time
+        stops.setdefault(station, (arrive_time, depart_time))
+    
+    return stops
+
+def query_station_time(date_str: str, train_code: str, station_name: str) -> Optional[Tuple[str, str]]:
+    """
+    查询指定日期、车次和车站的到达和开车时间
+    
+    :param date_str: 查询日期，示例格式 '2025-01-08'
+    :param train_code: 车次号，例如 'G20'
+    :param station_name: 车站名称，例如 '南京南'
+    :return: 返回一个元组 (到达时间, 开车时间)，如果未找到则返回 None
+    """
+    return query_station_times(date_str, train_code).get(station_name)
+
+def _parse_stops_json(payload: dict) -> Dict[str, Tuple[str, str]]:
+    """解析 12306 时刻表接口返回的 JSON"""
+    stops = {}
+    rows = ((payload or {}).get("data") or {}).get("data") or []
+    for row in rows:
+        station = (row.get("station_name") or "").strip()
+        if not station:
+            continue
+        arrive_time = row.get("arrive_time") or ""
+        depart_time = row.get("start_time") or ""
+        if arrive_time == "----":
+            arrive_time = ""
+        if depart_time == "----":
+            depart_time = ""
+        stops.setdefault(station, (arrive_time, depart_time))
+    return stops
+
+@timed()
+def query_train_stops(date_str: str, train_code: str) -> Dict[str, Tuple[str, str]]:
+    """
+    精简模式查询全部经停站时刻：拦截图片、字体、样式和统计脚本，
+    点击查询后直接读取时刻表接口的 JSON 响应，不等待 networkidle。
+    
+    :return: 返回字典 {车站名: (到达时间, 开车时间)}，失败时返回空字典
+    """
+    stats = {"requests": 0, "blocked": 0, "bytes": 0}
+    start = time.perf_counter()
+    
+    def handle_route(route):
+        request = route.request
+        if request.resource_type in BLOCKED_RESOURCE_TYPES or any(k in request.url for k in BLOCKED_URL_KEYWORDS):
+            stats["blocked"] += 1
+            route.abort()
+        else:
+            stats["requests"] += 1
+            route.continue_()
+    
+    def handle_request_finished(request):
+        # 请求完成后 sizes() 给出实际传输的响应头和（压缩后的）响应体大小
+        try:
+            sizes = request.sizes()
+        except Exception:
+            return
+        stats["bytes"] += max(sizes.get("responseBodySize", 0), 0) + max(sizes.get("responseHeadersSize", 0), 0)
     
-    return None
+    with sync_playwright() as p:
+        browser = None
+        try:
+            browser = p.chromium.launch(headless=True)
+            page = browser.new_page()
+            page.set_default_timeout(LOOKUP_STEP_TIMEOUT)
+            page.route("**/*", handle_route)
+            page.on("requestfinished", handle_request_finished)
+            
+            page.goto(TRAIN_INFO_URL, wait_until="domcontentloaded")
+            page.wait_for_selector("#train_start_date")
+            page.fill("#train_start_date", date_str)
+            page.fill("#numberValue", train_code)
+            
+            # 等待车次下拉列表出现后设置 train_no 属性
+            page.wait_for_selector("#train_hide li", state="attached")
+            train_no = page.evaluate("""
+            () => {
+                const item = document.querySelector('#train_hide li');
+                return item ? item.getAttribute('train_no') : null;
+            }
+            """)
+            if train_no:
+                page.evaluate("""
+                (train_no) => {
+                    const input = document.querySelector('#numberValue');
+                    input.setAttribute('train_no', train_no);
+                    input.dispatchEvent(new Event('change', { bubbles: true }));
+                }
+                """, train_no)
+            
+            with page.expect_response(lambda r: TRAIN_INFO_API in r.url) as response_info:
+                page.click("a.btn122s")
+            stops = _parse_stops_json(response_info.value.json())
+            return stops
+            
+        except Exception as e:
+            logging.warning(f"[查询] 精简模式查询 {train_code} 失败: {e}")
+            return {}
+        finally:
+            if browser:
+                browser.close()
+            logging.info(f"[查询] {date_str} {train_code} 精简模式耗时 {time.perf_counter() - start:.2f} 秒，"
+                         f"放行请求 {stats['requests']} 个，拦截 {stats['blocked']} 个，"
+                         f"传输约 {stats['bytes'] / 1024:.1f} KB")
 
+@timed()
 def query_train_info(date_str: str, train_code: str) -> str:
     """
     使用 Playwright 的无头浏览器在后端访问 12306 列车信息查询页面，输入日期和车次并点击查询，